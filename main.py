@@ -1,10 +1,20 @@
 # OWNER_ID is set to your Telegram ID (owner): 1850766719
 
 import os
+import io
+import json
+import time
+import uuid
+import random
+import hashlib
+import logging
+import functools
+import contextvars
 import psycopg2
 import asyncio
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
-from typing import Dict
+from typing import Dict, Tuple
 from telegram import BotCommand, MenuButtonCommands
 from telegram import (
     Update,
@@ -12,7 +22,8 @@ from telegram import (
     InlineKeyboardMarkup,
 )
 from telegram.ext import (ApplicationBuilder, ContextTypes, CommandHandler,
-                          CallbackQueryHandler, MessageHandler, filters)
+                          CallbackQueryHandler, MessageHandler, TypeHandler,
+                          filters)
 
 # ---------------- CONFIG ----------------
 OWNER_ID = 1850766719  # твой ID - владелец бота
@@ -20,8 +31,33 @@ TOKEN = os.getenv("TELEGRAM_TOKEN")
 GROUP_CHAT_ID = int(os.getenv("GROUP_CHAT_ID", "0"))
 BOSS_TOPIC_ID = int(os.getenv("BOSS_TOPIC_ID", "0"))
 
-if not TOKEN:
-    raise ValueError("Не найден TELEGRAM_TOKEN! Добавь его в Railway → Variables")
+# Политика доставки уведомлений (убийство, предупреждение, респавн, служебные):
+# warn_topic — всё в личку всем, предупреждения ещё и в топик "Босс" (если задан)
+# topic      — только в топик "Босс"
+# dm         — только в личку всем пользователям
+# both       — в топик и в личку всем
+# optin      — только в личку подписавшимся через /notify
+DELIVERY_MODES = ("warn_topic", "topic", "dm", "both", "optin")
+DELIVERY_MODE = os.getenv("DELIVERY_MODE", "warn_topic")
+# Служебные сообщения (рестарт, итоги /bulk_timers и /import_timers) идут
+# в топик только в режиме topic или при TOPIC_INFO=1
+TOPIC_INFO = os.getenv("TOPIC_INFO", "0") == "1"
+# Предупреждение и респавн в топике всегда приходят новыми сообщениями
+# (правки Telegram не уведомляют). При TOPIC_EDIT_IN_PLACE=1 к сообщению
+# об убийстве дописывается текущий статус — одна лишняя правка на событие.
+TOPIC_EDIT_IN_PLACE = os.getenv("TOPIC_EDIT_IN_PLACE", "0") == "1"
+
+if DELIVERY_MODE not in DELIVERY_MODES:
+    raise ValueError(f"DELIVERY_MODE должен быть одним из: {', '.join(DELIVERY_MODES)}")
+if DELIVERY_MODE in ("topic", "both") and not (GROUP_CHAT_ID and BOSS_TOPIC_ID):
+    raise ValueError(f"DELIVERY_MODE={DELIVERY_MODE} требует GROUP_CHAT_ID и BOSS_TOPIC_ID")
+
+# Логи — JSON, по строке на событие, с trace_id апдейта или события таймера.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# Доля трасс, для которых пишутся обычные события (ошибки и медленные — всегда)
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+# Порог медленной операции в мс (БД, отправка); 0 — выключено
+SLOW_OP_MS = float(os.getenv("SLOW_OP_MS", "0"))
 DB_PATH = "bot.db"
     
 # Two clans
@@ -56,17 +92,129 @@ BOSSES = {
     "18.Map ": 5,
     "19.Map ": 5,
 }
+# Самый дальний допустимый таймер для /bulk_timers и /import_timers (минуты)
+MAX_TIMER_MINUTES = 7 * 24 * 60
 # In-memory running tasks (boss_key -> asyncio.Task)
 boss_tasks: Dict[str, asyncio.Task] = {}
 
+# Минимальный интервал между правками сообщений в одном чате (сек)
+EDIT_MIN_INTERVAL = float(os.getenv("EDIT_MIN_INTERVAL", "1.0"))
+MESSAGE_HASH_CACHE_SIZE = 1000
+# (chat_id, message_id) -> хэш последнего отправленного содержимого
+message_content_hashes: Dict[Tuple[int, int], str] = {}
+# chat_id -> время последней или уже запланированной правки (time.monotonic)
+chat_last_edit: Dict[int, float] = {}
+# (chat_id, message_id) -> последняя отложенная правка и её задача
+pending_edits: Dict[Tuple[int, int], Dict] = {}
+pending_edit_tasks: Dict[Tuple[int, int], asyncio.Task] = {}
+# boss_key -> (message_id, текст) сообщения об убийстве в топике
+topic_kill_messages: Dict[str, Tuple[int, str]] = {}
+
+
+# ---------------- Logging ----------------
+trace_id_var = contextvars.ContextVar("trace_id", default=None)
+trace_sampled_var = contextvars.ContextVar("trace_sampled", default=True)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "event": record.getMessage(),
+            "trace_id": trace_id_var.get(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+logger = logging.getLogger("romnotice")
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(JsonFormatter())
+logger.addHandler(_log_handler)
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+
+
+def log_event(event: str, level: int = logging.INFO, exc_info=False, **fields):
+    # обычные события несэмплированных трасс отбрасываем
+    if level < logging.WARNING and not trace_sampled_var.get():
+        return
+    logger.log(level, event, exc_info=exc_info, extra={"fields": fields})
+
+
+def start_trace(kind: str, **fields) -> str:
+    """Начинает новую трассу в текущем контексте (апдейт или событие таймера)."""
+    trace_id = uuid.uuid4().hex[:16]
+    trace_id_var.set(trace_id)
+    trace_sampled_var.set(random.random() < LOG_SAMPLE_RATE)
+    log_event("trace.start", kind=kind, **fields)
+    return trace_id
+
+
+@contextmanager
+def traced(op: str, **fields):
+    """Замеряет операцию: ошибки и превышение SLOW_OP_MS пишутся всегда."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        ms = round((time.perf_counter() - start) * 1000, 1)
+        log_event("op.error", logging.ERROR, op=op, ms=ms, error=repr(e), **fields)
+        raise
+    ms = (time.perf_counter() - start) * 1000
+    if SLOW_OP_MS and ms >= SLOW_OP_MS:
+        log_event("op.slow", logging.WARNING, op=op, ms=round(ms, 1), **fields)
+    else:
+        log_event("op", logging.DEBUG, op=op, ms=round(ms, 1), **fields)
+
+
+async def tg_call(method: str, coro, **fields):
+    """Ожидает вызов Telegram API внутри traced("tg.<method>")."""
+    with traced(f"tg.{method}", **fields):
+        return await coro
+
+
+def traced_db(func):
+    """Оборачивает функцию работы с БД в traced("db.<имя>")."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with traced(f"db.{func.__name__}"):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+# ---------------- Clock ----------------
+class Clock:
+    """Источник времени для таймеров. Подменяется в replay.py на симулятор."""
+
+    def now(self) -> float:
+        return time.time()
+
+    async def sleep(self, seconds: float):
+        await asyncio.sleep(seconds)
+
+
+CLOCK = Clock()
+
 # ---------------- Database ----------------
-DB_CONN = psycopg2.connect(
-    host=os.environ.get("PGHOST"),
-    port=int(os.environ.get("PGPORT", 5432)),
-    user=os.environ.get("PGUSER"),
-    password=os.environ.get("PGPASSWORD"),
-    database=os.environ.get("PGDATABASE")
-)
+DB_CONN = None
+
+
+def connect_db():
+    """Подключается к базе и создаёт таблицы (вызывается при старте бота)."""
+    global DB_CONN
+    DB_CONN = psycopg2.connect(
+        host=os.environ.get("PGHOST"),
+        port=int(os.environ.get("PGPORT", 5432)),
+        user=os.environ.get("PGUSER"),
+        password=os.environ.get("PGPASSWORD"),
+        database=os.environ.get("PGDATABASE")
+    )
+    init_db()
+
 
 def init_db():
     """Создаёт таблицы пользователей и боссов, если их нет, и добавляет владельца."""
@@ -78,6 +226,10 @@ def init_db():
                 role TEXT NOT NULL DEFAULT 'user'
             )
         """)
+        c.execute("""
+            ALTER TABLE users
+            ADD COLUMN IF NOT EXISTS notify BOOLEAN NOT NULL DEFAULT FALSE
+        """)
 
         # Таблица боссов
         c.execute("""
@@ -107,11 +259,8 @@ def init_db():
     DB_CONN.commit()
 
 
-# Инициализация базы при старте
-init_db()
-
-
 # ---------------- Функции для работы с базой ----------------
+@traced_db
 def add_user_if_not_exists(telegram_id: int):
     with DB_CONN.cursor() as c:
         c.execute("SELECT telegram_id FROM users WHERE telegram_id = %s", (telegram_id,))
@@ -120,6 +269,7 @@ def add_user_if_not_exists(telegram_id: int):
     DB_CONN.commit()
 
 
+@traced_db
 def set_admin(telegram_id: int):
     with DB_CONN.cursor() as c:
         c.execute("""
@@ -130,6 +280,7 @@ def set_admin(telegram_id: int):
     DB_CONN.commit()
 
 
+@traced_db
 def is_admin(telegram_id: int) -> bool:
     if telegram_id == OWNER_ID:
         return True
@@ -139,12 +290,32 @@ def is_admin(telegram_id: int) -> bool:
     return r is not None and r[0] == "admin"
 
 
-def get_all_user_ids():
+@traced_db
+def get_all_user_ids(opted_in_only: bool = False):
     with DB_CONN.cursor() as c:
-        c.execute("SELECT telegram_id FROM users")
+        if opted_in_only:
+            c.execute("SELECT telegram_id FROM users WHERE notify")
+        else:
+            c.execute("SELECT telegram_id FROM users")
         return [row[0] for row in c.fetchall()]
 
 
+@traced_db
+def toggle_user_notify(telegram_id: int) -> bool:
+    """Переключает подписку на личные уведомления, возвращает новое значение."""
+    with DB_CONN.cursor() as c:
+        c.execute("""
+            INSERT INTO users (telegram_id, role, notify)
+            VALUES (%s, %s, TRUE)
+            ON CONFLICT (telegram_id) DO UPDATE SET notify = NOT users.notify
+            RETURNING notify
+        """, (telegram_id, "user"))
+        enabled = c.fetchone()[0]
+    DB_CONN.commit()
+    return enabled
+
+
+@traced_db
 def set_boss_killer_and_respawn(boss_name: str, killer: str, respawn_end_ts: int):
     with DB_CONN.cursor() as c:
         c.execute("""
@@ -155,6 +326,7 @@ def set_boss_killer_and_respawn(boss_name: str, killer: str, respawn_end_ts: int
     DB_CONN.commit()
 
 
+@traced_db
 def get_boss_info(boss_name: str):
     with DB_CONN.cursor() as c:
         c.execute("""
@@ -168,12 +340,48 @@ def get_boss_info(boss_name: str):
     return None
 
 
+@traced_db
 def get_all_bosses():
     with DB_CONN.cursor() as c:
         c.execute("SELECT name, respawn_hours, last_killer, respawn_end_ts FROM bosses")
         return c.fetchall()
 
 
+@traced_db
+def set_boss_timers_bulk(timers):
+    """timers: [(boss_name, killer, respawn_end_ts)] — одной транзакцией."""
+    try:
+        with DB_CONN.cursor() as c:
+            c.executemany("""
+                UPDATE bosses
+                SET last_killer = %s, respawn_end_ts = %s
+                WHERE name = %s
+            """, [(killer, ts, name) for name, killer, ts in timers])
+        DB_CONN.commit()
+    except Exception:
+        DB_CONN.rollback()
+        raise
+
+
+@traced_db
+def import_bosses(rows):
+    """rows: [(name, respawn_hours, last_killer, respawn_end_ts)] — одной транзакцией."""
+    try:
+        with DB_CONN.cursor() as c:
+            c.executemany("""
+                INSERT INTO bosses (name, respawn_hours, last_killer, respawn_end_ts)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (name) DO UPDATE
+                SET respawn_hours = EXCLUDED.respawn_hours,
+                    last_killer = EXCLUDED.last_killer,
+                    respawn_end_ts = EXCLUDED.respawn_end_ts
+            """, rows)
+        DB_CONN.commit()
+    except Exception:
+        DB_CONN.rollback()
+        raise
+
+
 
 # ---------------- Utilities ----------------
 def format_datetime_ts(ts: int) -> str:
@@ -182,18 +390,290 @@ def format_datetime_ts(ts: int) -> str:
     return datetime.fromtimestamp(ts, tz=tz).strftime("%d-%m %H:%M:%S")
 
 
-async def broadcast_message(application, text: str):
-    user_ids = get_all_user_ids()
+def format_kill_text(boss_name: str, clan: str, respawn_ts: int) -> str:
+    emoji_kill = "💀"
+    emoji_time = "⏰"
+    return f"{emoji_kill} <b>{boss_name}</b> убит кланом <b>{clan}</b>.\n{emoji_time} Следующее воскрешение - {format_datetime_ts(respawn_ts)}"
+
+
+def restart_boss_tasks(application, timers: Dict[str, int]):
+    """Перезапускает задачи уведомлений боссов (boss_key -> respawn_ts или None)."""
+    for boss_name, respawn_ts in timers.items():
+        # новый таймер — старое сообщение об убийстве больше не обновляем
+        topic_kill_messages.pop(boss_name, None)
+        task = boss_tasks.pop(boss_name, None)
+        if task and not task.done():
+            task.cancel()
+        if respawn_ts:
+            boss_tasks[boss_name] = asyncio.create_task(
+                boss_respawn_task(application, boss_name, respawn_ts))
+
+
+def schedule_boss(application, boss_name: str, killer, respawn_ts: int):
+    """Сохраняет таймер босса в БД и перезапускает его задачу уведомлений."""
+    set_boss_killer_and_respawn(boss_name, killer, respawn_ts)
+    restart_boss_tasks(application, {boss_name: respawn_ts})
+
+
+def find_boss(token: str):
+    """Ищет босса по полному имени или номеру карты ("02", "2", "02.Map")."""
+    token = token.strip()
+    for name in BOSSES:
+        number = name.split(".")[0]
+        if token in (name, name.strip()) or token.zfill(2) == number:
+            return name
+    return None
+
+
+def parse_bulk_spec(text: str):
+    """
+    Разбирает строки вида "босс, клан, минуты".
+    Клан "-" оставляет прежнего убийцу. Каждый босс — не больше одного раза.
+    Возвращает (список (boss, clan, minutes), список ошибок).
+    """
+    entries, errors = [], []
+    seen: Dict[str, int] = {}
+    for line_no, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        parts = [p.strip() for p in line.replace(";", ",").split(",")]
+        if len(parts) != 3:
+            errors.append(f"{line_no}: нужно 3 поля — босс, клан, минуты")
+            continue
+        boss_name = find_boss(parts[0])
+        if boss_name is None:
+            errors.append(f"{line_no}: неизвестный босс {parts[0]}")
+            continue
+        if boss_name in seen:
+            errors.append(f"{line_no}: {boss_name.strip()} уже указан в строке {seen[boss_name]}")
+            continue
+        seen[boss_name] = line_no
+        clan = parts[1]
+        if clan != "-" and clan not in CLANS:
+            errors.append(f"{line_no}: неизвестный клан {clan}")
+            continue
+        if not parts[2].isdigit():
+            errors.append(f"{line_no}: минуты должны быть числом")
+            continue
+        if int(parts[2]) > MAX_TIMER_MINUTES:
+            errors.append(f"{line_no}: не больше {MAX_TIMER_MINUTES} минут")
+            continue
+        entries.append((boss_name, clan, int(parts[2])))
+    return entries, errors
+
+
+async def broadcast_message(application, text: str, user_ids=None):
+    if user_ids is None:
+        user_ids = get_all_user_ids()
+    sent = failed = 0
     for uid in user_ids:
         try:
-            await application.bot.send_message(
-                chat_id=uid,
+            with traced("tg.send_message", chat_id=uid):
+                await application.bot.send_message(
+                    chat_id=uid,
+                    text=text,
+                    parse_mode="HTML"  # включаем поддержку HTML
+                )
+            sent += 1
+        except Exception:
+            # ignore failed sends (user blocked bot etc.), ошибка уже в логе
+            failed += 1
+    log_event("broadcast", recipients=len(user_ids), sent=sent, failed=failed)
+
+
+# ---------------- Message edits ----------------
+def _callback_key(data):
+    # отбрасываем метку времени в конце callback_data ("уникальность кнопок")
+    if not data:
+        return data
+    parts = data.split("|")
+    if len(parts) > 1 and parts[-1].isdigit():
+        parts = parts[:-1]
+    return "|".join(parts)
+
+
+def message_content_hash(text: str, reply_markup=None, parse_mode=None) -> str:
+    """Хэш видимого содержимого сообщения: текст, режим разметки и кнопки."""
+    rows = []
+    if reply_markup is not None:
+        for row in reply_markup.inline_keyboard:
+            rows.append([(b.text, _callback_key(b.callback_data)) for b in row])
+    payload = json.dumps([text, parse_mode, rows], ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def _remember_content_hash(key: Tuple[int, int], content_hash: str):
+    message_content_hashes.pop(key, None)
+    message_content_hashes[key] = content_hash
+    while len(message_content_hashes) > MESSAGE_HASH_CACHE_SIZE:
+        # самая старая запись
+        message_content_hashes.pop(next(iter(message_content_hashes)))
+
+
+async def _send_edit(bot, chat_id: int, message_id: int, text: str,
+                     reply_markup, parse_mode, content_hash: str):
+    # не сдвигаем назад слот, уже занятый отложенной правкой
+    chat_last_edit[chat_id] = max(chat_last_edit.get(chat_id, 0),
+                                  time.monotonic())
+    with traced("tg.edit_message_text", chat_id=chat_id, message_id=message_id):
+        try:
+            await bot.edit_message_text(chat_id=chat_id,
+                                        message_id=message_id,
+                                        text=text,
+                                        reply_markup=reply_markup,
+                                        parse_mode=parse_mode)
+        except Exception as e:
+            if "Message is not modified" not in str(e):
+                raise
+    _remember_content_hash((chat_id, message_id), content_hash)
+
+
+async def _flush_pending_edit(bot, chat_id: int, message_id: int,
+                              delay: float):
+    key = (chat_id, message_id)
+    try:
+        await asyncio.sleep(delay)
+    finally:
+        pending_edit_tasks.pop(key, None)
+    edit = pending_edits.pop(key, None)
+    if not edit:
+        return
+    content_hash = message_content_hash(edit["text"], edit["reply_markup"],
+                                        edit["parse_mode"])
+    if message_content_hashes.get(key) == content_hash:
+        return
+    try:
+        await _send_edit(bot, chat_id, message_id, edit["text"],
+                         edit["reply_markup"], edit["parse_mode"],
+                         content_hash)
+    except Exception:
+        # ошибка уже записана в traced
+        pass
+
+
+async def edit_message_throttled(bot, chat_id: int, message_id: int,
+                                 text: str, reply_markup=None,
+                                 parse_mode=None):
+    """
+    Редактирует сообщение, экономя запросы к API:
+    - Если содержимое не изменилось → запрос не отправляется.
+    - Если в чате недавно была правка → быстрые повторные нажатия
+      схлопываются в одну отложенную правку с последним содержимым.
+    Отложенные правки разных сообщений одного чата встают в очередь
+    с шагом EDIT_MIN_INTERVAL, а не уходят одной пачкой.
+    """
+    key = (chat_id, message_id)
+    content_hash = message_content_hash(text, reply_markup, parse_mode)
+    if key in pending_edits:
+        # последняя версия заменяет предыдущую отложенную
+        pending_edits[key] = {"text": text,
+                              "reply_markup": reply_markup,
+                              "parse_mode": parse_mode}
+        return
+    if message_content_hashes.get(key) == content_hash:
+        log_event("edit.skipped", chat_id=chat_id, message_id=message_id)
+        return
+
+    wait = chat_last_edit.get(chat_id, 0) + EDIT_MIN_INTERVAL - time.monotonic()
+    if wait <= 0:
+        await _send_edit(bot, chat_id, message_id, text, reply_markup,
+                         parse_mode, content_hash)
+        return
+
+    # занимаем слот чата, чтобы следующая отложенная правка шла после этой
+    chat_last_edit[chat_id] = time.monotonic() + wait
+    pending_edits[key] = {"text": text,
+                          "reply_markup": reply_markup,
+                          "parse_mode": parse_mode}
+    pending_edit_tasks[key] = asyncio.create_task(
+        _flush_pending_edit(bot, chat_id, message_id, wait))
+    log_event("edit.deferred", chat_id=chat_id, message_id=message_id,
+              delay_ms=round(wait * 1000, 1))
+
+
+async def edit_query_message(query, text: str, reply_markup=None,
+                             parse_mode=None):
+    await edit_message_throttled(query.get_bot(),
+                                 query.message.chat_id,
+                                 query.message.message_id,
+                                 text,
+                                 reply_markup=reply_markup,
+                                 parse_mode=parse_mode)
+
+
+# ---------------- Delivery ----------------
+async def _update_kill_status(application, kind: str, text: str,
+                              boss_name: str):
+    entry = topic_kill_messages.get(boss_name)
+    if not entry:
+        return
+    msg_id, kill_text = entry
+    status_text = f"{kill_text}\n\nСтатус: {text}"
+    # без троттлинга: правки разных боссов не должны откладываться
+    try:
+        await _send_edit(application.bot, GROUP_CHAT_ID, msg_id, status_text,
+                         None, "HTML",
+                         message_content_hash(status_text, None, "HTML"))
+    except Exception:
+        log_event("topic.status_edit_failed", logging.WARNING, boss=boss_name)
+    if kind == "respawn":
+        # цикл босса завершён
+        topic_kill_messages.pop(boss_name, None)
+
+
+async def send_to_topic(application, kind: str, text: str, boss_name=None):
+    if not GROUP_CHAT_ID or not BOSS_TOPIC_ID:
+        return
+    message = None
+    try:
+        with traced("tg.send_message", chat_id=GROUP_CHAT_ID, topic=True):
+            message = await application.bot.send_message(
+                chat_id=GROUP_CHAT_ID,
+                message_thread_id=BOSS_TOPIC_ID,
                 text=text,
-                parse_mode="HTML"  # включаем поддержку HTML
+                parse_mode="HTML"
             )
-        except Exception:
-            # ignore failed sends (user blocked bot etc.)
-            pass
+    except Exception:
+        # ошибка уже записана в traced
+        pass
+
+    if not boss_name:
+        return
+    if kind == "kill" and message is not None:
+        topic_kill_messages[boss_name] = (message.message_id, text)
+    elif TOPIC_EDIT_IN_PLACE and kind in ("warn", "respawn"):
+        await _update_kill_status(application, kind, text, boss_name)
+
+
+async def deliver_event(application, kind: str, text: str, boss_name=None,
+                        scheduled_ts=None):
+    """
+    Доставляет событие согласно DELIVERY_MODE.
+    kind: "kill" | "warn" | "respawn" | "info"
+    scheduled_ts — плановое время уведомления (для таймерных событий).
+    """
+    fields = {"kind": kind, "boss": boss_name, "mode": DELIVERY_MODE}
+    if scheduled_ts is not None:
+        # насколько позже плана началась доставка
+        fields["scheduled_ts"] = scheduled_ts
+        fields["lateness_s"] = round(CLOCK.now() - scheduled_ts, 3)
+    log_event("deliver", **fields)
+    if DELIVERY_MODE in ("warn_topic", "dm", "both"):
+        await broadcast_message(application, text)
+    elif DELIVERY_MODE == "optin":
+        await broadcast_message(application, text,
+                                get_all_user_ids(opted_in_only=True))
+
+    if DELIVERY_MODE == "warn_topic":
+        to_topic = kind == "warn"
+    elif DELIVERY_MODE == "both":
+        to_topic = kind != "info" or TOPIC_INFO
+    else:
+        # в режиме topic это единственный канал, служебные тоже туда
+        to_topic = DELIVERY_MODE == "topic"
+    if to_topic:
+        await send_to_topic(application, kind, text, boss_name)
 
 
 def build_menu_keyboard():
@@ -202,7 +682,7 @@ def build_menu_keyboard():
     for name, hours in BOSSES.items():
         info = get_boss_info(name)
         last = info["last_killer"] if info and info["last_killer"] else "—"
-        now_ts = int(datetime.now().timestamp())
+        now_ts = int(CLOCK.now())
 
         respawn_ts = info["respawn_end_ts"] if info and info["respawn_end_ts"] else None
         if respawn_ts and respawn_ts > now_ts:
@@ -259,6 +739,22 @@ def build_boss_choice_keyboard(boss_name: str):
 
 
 # ---------------- Handlers ----------------
+async def trace_update_handler(update: Update,
+                               context: ContextTypes.DEFAULT_TYPE):
+    # группа -1: выполняется перед остальными обработчиками того же апдейта
+    user = update.effective_user
+    start_trace("update",
+                update_id=update.update_id,
+                user_id=user.id if user else None,
+                chat_id=update.effective_chat.id if update.effective_chat else None)
+
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    # вместо стандартного текстового лога PTB — JSON с trace_id апдейта
+    log_event("handler.error", logging.ERROR, exc_info=context.error,
+              update_id=update.update_id if isinstance(update, Update) else None)
+
+
 async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if user is None:
@@ -271,7 +767,7 @@ async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("Start ▶️", callback_data="first_start")],
     ])
 
-    await update.effective_chat.send_message(text, reply_markup=keyboard)
+    await tg_call("send_message", update.effective_chat.send_message(text, reply_markup=keyboard))
 
 
 async def help_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -280,6 +776,9 @@ async def help_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "- /start — регистрация в системе и получение меню боссов\n"
         "- /menu — открыть главное меню боссов\n"
         "- /add_admin [id] — назначение админа (только владелец бота)\n"
+        "- /notify — включить/выключить личные уведомления\n"
+        "- /bulk_timers — массовая установка таймеров (админы)\n"
+        "- /export_timers, /import_timers — выгрузка и загрузка таймеров в JSON (админы)\n"
         "- Главное меню показывает всех боссов, чей клан в очереди и время воскрешения\n"
         "- Нажав на босса, <b>админ</b> может выбрать клан, который убил босса\n"
         "- 💀 Уведомление о убийстве босса рассылается всем пользователям\n"
@@ -287,7 +786,7 @@ async def help_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "- ⚔️ Уведомление о том, что босс снова доступен для убийства\n"
         "- Кнопка 'Обновить 🔄' — обновление главного меню\n"
         "Админы могут отмечать убийства босса в меню.")
-    await update.effective_chat.send_message(text, parse_mode="HTML")
+    await tg_call("send_message", update.effective_chat.send_message(text, parse_mode="HTML"))
 
 
     # send persistent start -> menu button
@@ -296,15 +795,17 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not user:
         return
         # показываем меню боссов
-    await update.message.reply_text("Меню:",
-                                    reply_markup=build_menu_keyboard(),
-                                    parse_mode="HTML")
+    await tg_call("reply_text",
+                  update.message.reply_text("Меню:",
+                                            reply_markup=build_menu_keyboard(),
+                                            parse_mode="HTML"))
     keyboard = InlineKeyboardMarkup([
         [InlineKeyboardButton("Start ▶️", callback_data="first_start")],
     ])
-    await update.message.reply_text(text,
-                                    reply_markup=keyboard,
-                                    parse_mode="HTML")
+    await tg_call("reply_text",
+                  update.message.reply_text(text,
+                                            reply_markup=keyboard,
+                                            parse_mode="HTML"))
 
 
 async def add_admin_handler(update: Update,
@@ -313,21 +814,165 @@ async def add_admin_handler(update: Update,
     if user is None:
         return
     if user.id != OWNER_ID:
-        await update.message.reply_text(
-            "❌ Только владелец бота может назначать админов.")
+        await tg_call("reply_text", update.message.reply_text(
+            "❌ Только владелец бота может назначать админов."))
         return
     args = context.args
     if not args:
-        await update.message.reply_text(
-            "Использование: /add_admin <telegram_id>")
+        await tg_call("reply_text", update.message.reply_text(
+            "Использование: /add_admin <telegram_id>"))
         return
     try:
         tid = int(args[0])
     except ValueError:
-        await update.message.reply_text("ID должен быть числом.")
+        await tg_call("reply_text", update.message.reply_text("ID должен быть числом."))
         return
     set_admin(tid)
-    await update.message.reply_text(f"✅ Пользователь {tid} назначен админом.")
+    await tg_call("reply_text", update.message.reply_text(f"✅ Пользователь {tid} назначен админом."))
+
+
+async def notify_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user is None:
+        return
+    if toggle_user_notify(user.id):
+        text = "🔔 Личные уведомления включены."
+    else:
+        text = "🔕 Личные уведомления выключены."
+    if DELIVERY_MODE != "optin":
+        text += "\n(Сейчас уведомления в личку рассылаются по общим правилам.)"
+    await tg_call("reply_text", update.message.reply_text(text))
+
+
+async def bulk_timers_handler(update: Update,
+                              context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not user or not is_admin(user.id):
+        await tg_call("reply_text", update.message.reply_text("❌ Только админы могут настраивать таймеры."))
+        return
+
+    parts = update.message.text.split(None, 1)
+    if len(parts) < 2:
+        await tg_call("reply_text", update.message.reply_text(
+            "Использование:\n/bulk_timers\n02, BALDEG, 120\n03, AlterEgo, 45\n"
+            "Клан \"-\" оставляет прежнего убийцу."))
+        return
+
+    entries, errors = parse_bulk_spec(parts[1])
+    if errors:
+        # ничего не применяем, пока в списке есть ошибки
+        await tg_call("reply_text", update.message.reply_text("❌ Ошибки:\n" + "\n".join(errors)))
+        return
+    if not entries:
+        await tg_call("reply_text", update.message.reply_text("❌ Пустой список таймеров."))
+        return
+
+    last_killers = {name: killer for name, _, killer, _ in get_all_bosses()}
+    now_ts = int(CLOCK.now())
+    timers = {}
+    for boss_name, clan, minutes in entries:
+        killer = last_killers.get(boss_name) if clan == "-" else clan
+        timers[boss_name] = (killer, now_ts + minutes * 60)
+
+    log_event("bulk_timers.apply", count=len(timers))
+    set_boss_timers_bulk([(name, killer, ts)
+                          for name, (killer, ts) in timers.items()])
+    restart_boss_tasks(context.application,
+                       {name: ts for name, (_, ts) in timers.items()})
+
+    lines = [f"🛠 Таймеры обновлены ({len(timers)}):"]
+    for name, (killer, ts) in timers.items():
+        lines.append(f"<b>{name}</b> — {killer or '—'}, воскрешение {format_datetime_ts(ts)}")
+    await deliver_event(context.application, "info", "\n".join(lines))
+    await tg_call("reply_text", update.message.reply_text(f"✅ Применено таймеров: {len(timers)}."))
+
+
+async def export_timers_handler(update: Update,
+                                context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not user or not is_admin(user.id):
+        await tg_call("reply_text", update.message.reply_text("❌ Только админы могут выгружать таймеры."))
+        return
+
+    bosses = [{"name": name,
+               "respawn_hours": hours,
+               "last_killer": last_killer,
+               "respawn_end_ts": respawn_end_ts}
+              for name, hours, last_killer, respawn_end_ts in get_all_bosses()]
+    payload = {"version": 1, "exported_at": int(CLOCK.now()), "bosses": bosses}
+    data = json.dumps(payload, ensure_ascii=False, indent=2).encode("utf-8")
+    await tg_call("reply_document",
+                  update.message.reply_document(document=io.BytesIO(data),
+                                                filename="bosses.json"))
+
+
+async def import_timers_handler(update: Update,
+                                context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not user or not is_admin(user.id):
+        await tg_call("reply_text", update.message.reply_text("❌ Только админы могут загружать таймеры."))
+        return
+
+    # JSON либо после команды, либо в файле, на который отвечает команда
+    parts = update.message.text.split(None, 1)
+    reply = update.message.reply_to_message
+    if len(parts) < 2 and not (reply and reply.document):
+        await tg_call("reply_text", update.message.reply_text(
+            "Использование: ответьте /import_timers на файл из /export_timers "
+            "или вставьте JSON после команды."))
+        return
+
+    try:
+        if len(parts) > 1:
+            raw = parts[1]
+        else:
+            file = await tg_call("get_file", reply.document.get_file())
+            data = await tg_call("download_as_bytearray",
+                                 file.download_as_bytearray())
+            raw = bytes(data).decode("utf-8")
+        payload = json.loads(raw)
+        items = payload["bosses"] if isinstance(payload, dict) else payload
+        max_ts = int(CLOCK.now()) + MAX_TIMER_MINUTES * 60
+        rows = []
+        for item in items:
+            name = item["name"]
+            if name not in BOSSES:
+                raise ValueError(f"неизвестный босс {name}")
+            # время респавна задаётся в BOSSES, другое значение не применится
+            hours = item.get("respawn_hours", BOSSES[name])
+            if hours != BOSSES[name]:
+                raise ValueError(f"{name}: respawn_hours {hours} не совпадает "
+                                 f"с настройкой бота ({BOSSES[name]})")
+            last_killer = item.get("last_killer")
+            if last_killer is not None and last_killer not in CLANS:
+                raise ValueError(f"{name}: неизвестный клан {last_killer}")
+            respawn_end_ts = item.get("respawn_end_ts")
+            if respawn_end_ts is not None:
+                respawn_end_ts = int(respawn_end_ts)
+                if respawn_end_ts > max_ts:
+                    raise ValueError(f"{name}: respawn_end_ts дальше "
+                                     f"{MAX_TIMER_MINUTES} минут от текущего времени")
+            rows.append((name, BOSSES[name], last_killer, respawn_end_ts))
+    except (ValueError, KeyError, TypeError) as e:
+        # UnicodeDecodeError — тоже ValueError
+        await tg_call("reply_text", update.message.reply_text(f"❌ Неверный JSON: {e}"))
+        return
+
+    # истёкшие таймеры не переносим, иначе сразу придут уведомления о респавне
+    now_ts = int(CLOCK.now())
+    rows = [(name, hours, killer, ts if ts and ts > now_ts else None)
+            for name, hours, killer, ts in rows]
+
+    log_event("import_timers.apply", count=len(rows))
+    import_bosses(rows)
+    restart_boss_tasks(context.application,
+                       {name: ts for name, _, _, ts in rows})
+
+    active = sum(1 for row in rows if row[3])
+    await deliver_event(
+        context.application, "info",
+        f"🛠 Таймеры боссов загружены: {len(rows)}, активных: {active}.")
+    await tg_call("reply_text", update.message.reply_text(f"✅ Загружено боссов: {len(rows)}."))
 
 
 async def callback_query_handler(update: Update,
@@ -336,22 +981,19 @@ async def callback_query_handler(update: Update,
     if not query:
         return
     data = query.data or ""
-    await query.answer()
+    await tg_call("answer", query.answer())
     application = context.application
 
     parts = data.split("|")
     key = parts[0]
+    log_event("callback", key=key, data=data)
 
     # ---------------- Start / Refresh menu ----------------
     if key in ("first_start", "menu_refresh"):
         text = "Меню:\u200b"
-        try:
-            await query.message.edit_text(text,
-                                          reply_markup=build_menu_keyboard(),
-                                          parse_mode="HTML")
-        except Exception as e:
-            if "Message is not modified" not in str(e):
-                raise
+        await edit_query_message(query, text,
+                                 reply_markup=build_menu_keyboard(),
+                                 parse_mode="HTML")
         return
 
     # ---------------- Boss view ----------------
@@ -359,13 +1001,9 @@ async def callback_query_handler(update: Update,
         boss_name = parts[1]
         keyboard = build_boss_choice_keyboard(boss_name)
         text = f"Босс: <b>{boss_name}</b>\nВыберите клан убивший босса:\u200b"
-        try:
-            await query.message.edit_text(text,
-                                          reply_markup=keyboard,
-                                          parse_mode="HTML")
-        except Exception as e:
-            if "Message is not modified" not in str(e):
-                raise
+        await edit_query_message(query, text,
+                                 reply_markup=keyboard,
+                                 parse_mode="HTML")
         return
 
     # ---------------- Boss other ----------------
@@ -378,21 +1016,11 @@ async def callback_query_handler(update: Update,
         hours = BOSSES.get(boss_name)
         if hours is None:
             return
-        respawn_ts = int((datetime.now() + timedelta(hours=hours)).timestamp())
-        set_boss_killer_and_respawn(boss_name, last_killer, respawn_ts)
-        if boss_name in boss_tasks:
-            task = boss_tasks[boss_name]
-            if not task.done():
-                task.cancel()
-        boss_tasks[boss_name] = asyncio.create_task(
-            boss_respawn_task(application, boss_name, respawn_ts))
-        try:
-            await query.message.edit_text("Меню:\u200b",
-                                          reply_markup=build_menu_keyboard(),
-                                          parse_mode="HTML")
-        except Exception as e:
-            if "Message is not modified" not in str(e):
-                raise
+        respawn_ts = int(CLOCK.now() + hours * 3600)
+        schedule_boss(application, boss_name, last_killer, respawn_ts)
+        await edit_query_message(query, "Меню:\u200b",
+                                 reply_markup=build_menu_keyboard(),
+                                 parse_mode="HTML")
         return
 
     # ---------------- Boss setup ----------------
@@ -400,8 +1028,9 @@ async def callback_query_handler(update: Update,
         boss_name = parts[1]
         user = query.from_user
         if not user or not is_admin(user.id):
-            await query.answer("❌ Только админы могут настраивать таймеры.",
-                               show_alert=True)
+            await tg_call("answer",
+                          query.answer("❌ Только админы могут настраивать таймеры.",
+                                       show_alert=True))
             return
 
         keyboard_buttons = [[
@@ -414,13 +1043,10 @@ async def callback_query_handler(update: Update,
                 callback_data=f"menu_back|{int(datetime.now().timestamp())}")
         ])
         keyboard = InlineKeyboardMarkup(keyboard_buttons)
-        try:
-            await query.message.edit_text(
-                f"Выберите клан, забравший лут для {boss_name}:\u200b",
-                reply_markup=keyboard)
-        except Exception as e:
-            if "Message is not modified" not in str(e):
-                raise
+        await edit_query_message(
+            query,
+            f"Выберите клан, забравший лут для {boss_name}:\u200b",
+            reply_markup=keyboard)
         return
 
     # ---------------- Boss setup clan (custom timer input) ----------------
@@ -434,7 +1060,8 @@ async def callback_query_handler(update: Update,
             "chat_id": query.message.chat_id
         }
         # редактируем меню на инструкцию
-        await query.message.edit_text(
+        await edit_query_message(
+            query,
             f"Введите количество минут до респавна для {boss_name} (клан {clan}):"
         )
         return
@@ -444,46 +1071,31 @@ async def callback_query_handler(update: Update,
         boss_name, clan = parts[1], parts[2]
         user = query.from_user
         if not user or not is_admin(user.id):
-            await query.answer("❌ Только админы могут отмечать убийство.",
-                               show_alert=True)
+            await tg_call("answer",
+                          query.answer("❌ Только админы могут отмечать убийство.",
+                                       show_alert=True))
             return
 
         hours = BOSSES.get(boss_name)
         if hours is None:
-            await query.message.reply_text("Ошибка: неизвестный босс.")
+            await tg_call("reply_text", query.message.reply_text("Ошибка: неизвестный босс."))
             return
 
-        respawn_ts = int((datetime.now() + timedelta(hours=hours)).timestamp())
-        set_boss_killer_and_respawn(boss_name, clan, respawn_ts)
-        if boss_name in boss_tasks:
-            task = boss_tasks[boss_name]
-            if not task.done():
-                task.cancel()
-        boss_tasks[boss_name] = asyncio.create_task(
-            boss_respawn_task(application, boss_name, respawn_ts))
-
-        emoji_kill = "💀"
-        emoji_time = "⏰"
-        text = f"{emoji_kill} <b>{boss_name}</b> убит кланом <b>{clan}</b>.\n{emoji_time} Следующее воскрешение - {format_datetime_ts(respawn_ts)}"
-        await broadcast_message(application, text)
-        try:
-            await query.message.edit_text("Меню:\u200b",
-                                          reply_markup=build_menu_keyboard(),
-                                          parse_mode="HTML")
-        except Exception as e:
-            if "Message is not modified" not in str(e):
-                raise
+        respawn_ts = int(CLOCK.now() + hours * 3600)
+        schedule_boss(application, boss_name, clan, respawn_ts)
+
+        text = format_kill_text(boss_name, clan, respawn_ts)
+        await deliver_event(application, "kill", text, boss_name)
+        await edit_query_message(query, "Меню:\u200b",
+                                 reply_markup=build_menu_keyboard(),
+                                 parse_mode="HTML")
         return
 
     # ---------------- Back to menu ----------------
     if key == "menu_back":
-        try:
-            await query.message.edit_text("Меню боссов:\u200b",
-                                          reply_markup=build_menu_keyboard(),
-                                          parse_mode="HTML")
-        except Exception as e:
-            if "Message is not modified" not in str(e):
-                raise
+        await edit_query_message(query, "Меню боссов:\u200b",
+                                 reply_markup=build_menu_keyboard(),
+                                 parse_mode="HTML")
         return
 
     # ---------------- Help ----------------
@@ -493,70 +1105,17 @@ async def callback_query_handler(update: Update,
             "- /start — регистрация и меню боссов\n"
             "- /menu — открыть главное меню боссов\n"
             "- /add_admin [id] — назначение админа (только владелец бота)\n"
+            "- /notify — включить/выключить личные уведомления\n"
+            "- /bulk_timers — массовая установка таймеров (админы)\n"
+            "- /export_timers, /import_timers — выгрузка и загрузка таймеров в JSON (админы)\n"
             "- Главное меню показывает всех боссов, чей клан в очереди и время воскрешения\n"
             "- Нажав на босса, <b>админ</b> может выбрать клан, который убил босса\n"
             "- 💀 Уведомление о убийстве босса рассылается всем пользователям\n"
             "- 🔔 За 10 минут до воскрешения приходит предупреждение с очередью клана\n"
             "- ⚔️ Уведомление о том, что босс снова доступен для убийства\n"
             "- Кнопка 'Обновить 🔄' — обновление главного меню")
-        await query.message.reply_text(help_text, parse_mode="HTML")
-        return
-
-
-async def custom_timer_input_handler(update: Update,
-                                     context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    if not user or not is_admin(user.id):
-        return
-
-    # Игнорируем сообщения из топиков/групп
-    if update.effective_chat.type in ("group", "supergroup") and update.effective_chat.id != user.id:
-        return
-        
-    text = update.message.text.strip()
-    if not text.isdigit():
-        await update.message.reply_text("❌ Нужно ввести число минут.")
+        await tg_call("reply_text", query.message.reply_text(help_text, parse_mode="HTML"))
         return
-    minutes = int(text)
-
-    for boss_name, data in list(awaiting_custom_timer.items()):
-        if data.get("awaiting_minutes"):
-            clan = data["clan"]
-            respawn_ts = int(
-                (datetime.now() + timedelta(minutes=minutes)).timestamp())
-
-            # обновляем БД
-            set_boss_killer_and_respawn(boss_name, clan, respawn_ts)
-
-            # отменяем старую задачу
-            if boss_name in boss_tasks:
-                task = boss_tasks[boss_name]
-                if not task.done():
-                    task.cancel()
-
-            # создаём новую задачу
-            task = asyncio.create_task(
-                boss_respawn_task(context.application, boss_name, respawn_ts))
-            boss_tasks[boss_name] = task
-
-            # удаляем старое меню (редактируем сообщение, где был выбор клана)
-            try:
-                msg_id = data.get("message_id")
-                if msg_id:
-                    await context.bot.edit_message_text(
-                        chat_id=update.effective_chat.id,
-                        message_id=msg_id,
-                        text="✅ Таймер установлен.")
-            except Exception:
-                pass
-
-            # удаляем элемент ожидания
-            del awaiting_custom_timer[boss_name]
-
-            # показываем главное меню
-            await update.effective_chat.send_message(
-                "Главное меню:", reply_markup=build_menu_keyboard())
-            break
 
 
 # ---------------- Background task for respawn reminders ----------------
@@ -568,23 +1127,26 @@ async def boss_respawn_task(application, boss_name: str, respawn_ts: int):
     - Если уже прошло → сразу уведомление и очистка.
     """
     try:
-        now_ts = int(datetime.now().timestamp())
+        now_ts = int(CLOCK.now())
         warn_ts = respawn_ts - 10 * 60
 
         if respawn_ts <= now_ts:
             # Уже прошло → сразу уведомляем
+            start_trace("timer.respawn", boss=boss_name, scheduled_ts=respawn_ts)
             emoji_revive = "⚔️"
             text = f"{emoji_revive} {boss_name} теперь снова доступен для убийства!"
-            await broadcast_message(application, text)
+            await deliver_event(application, "respawn", text, boss_name,
+                                scheduled_ts=respawn_ts)
 
             info = get_boss_info(boss_name)
             set_boss_killer_and_respawn(boss_name, info["last_killer"], None)
-            print(f"[task] {boss_name}: время прошло, уведомление отправлено, таймер очищен.")
+            log_event("timer.done", boss=boss_name, overdue=True)
             return
 
         # --- предупреждение, если оно ещё актуально ---
         if warn_ts > now_ts:
-            await asyncio.sleep(warn_ts - now_ts)
+            await CLOCK.sleep(warn_ts - now_ts)
+            start_trace("timer.warn", boss=boss_name, scheduled_ts=warn_ts)
 
             info = get_boss_info(boss_name)
             last_killer = info["last_killer"] if info else None
@@ -598,40 +1160,31 @@ async def boss_respawn_task(application, boss_name: str, respawn_ts: int):
             if queue_clan:
                 text += f"\nОчередь клана - {queue_clan}."
 
-            # уведомление пользователям
-            await broadcast_message(application, text)
-
-            # уведомление в топик "Босс"
-            if GROUP_CHAT_ID and BOSS_TOPIC_ID:
-                try:
-                    await application.bot.send_message(
-                        chat_id=GROUP_CHAT_ID,
-                        message_thread_id=BOSS_TOPIC_ID,
-                        text=text,
-                        parse_mode="HTML"
-                    )
-                except Exception as e:
-                    print(f"Ошибка отправки в топик: {e}")
+            # уведомление пользователям и в топик "Босс"
+            await deliver_event(application, "warn", text, boss_name,
+                                scheduled_ts=warn_ts)
 
         # --- респавн ---
-        now_ts = int(datetime.now().timestamp())
+        now_ts = int(CLOCK.now())
         if respawn_ts > now_ts:
-            await asyncio.sleep(respawn_ts - now_ts)
+            await CLOCK.sleep(respawn_ts - now_ts)
+        start_trace("timer.respawn", boss=boss_name, scheduled_ts=respawn_ts)
 
         emoji_revive = "⚔️"
         text = f"{emoji_revive} {boss_name} теперь снова доступен для убийства!"
-        await broadcast_message(application, text)
+        await deliver_event(application, "respawn", text, boss_name,
+                            scheduled_ts=respawn_ts)
 
         # очищаем respawn_end_ts
         info = get_boss_info(boss_name)
         set_boss_killer_and_respawn(boss_name, info["last_killer"], None)
 
-        print(f"[task] {boss_name}: респавн обработан, таймер очищен.")
+        log_event("timer.done", boss=boss_name)
 
     except asyncio.CancelledError:
         return
-    except Exception as e:
-        print(f"Ошибка в boss_respawn_task: {e}")
+    except Exception:
+        log_event("timer.error", logging.ERROR, exc_info=True, boss=boss_name)
 
 async def custom_timer_input_handler(update: Update,
                                      context: ContextTypes.DEFAULT_TYPE):
@@ -641,48 +1194,37 @@ async def custom_timer_input_handler(update: Update,
 
     text = update.message.text.strip()
     if not text.isdigit():
-        await update.message.reply_text("❌ Нужно ввести число минут.")
+        await tg_call("reply_text", update.message.reply_text("❌ Нужно ввести число минут."))
         return
     minutes = int(text)
 
     for boss_name, data in list(awaiting_custom_timer.items()):
         if data.get("awaiting_minutes"):
             clan = data["clan"]
-            respawn_ts = int(
-                (datetime.now() + timedelta(minutes=minutes)).timestamp())
-
-            # обновляем БД
-            set_boss_killer_and_respawn(boss_name, clan, respawn_ts)
-
-            # отменяем старую задачу
-            if boss_name in boss_tasks:
-                task = boss_tasks[boss_name]
-                if not task.done():
-                    task.cancel()
+            respawn_ts = int(CLOCK.now() + minutes * 60)
 
-            # создаём новую задачу
-            task = asyncio.create_task(
-                boss_respawn_task(context.application, boss_name, respawn_ts))
-            boss_tasks[boss_name] = task
+            # обновляем БД и перезапускаем задачу
+            log_event("custom_timer.set", boss=boss_name, clan=clan,
+                      minutes=minutes, respawn_ts=respawn_ts)
+            schedule_boss(context.application, boss_name, clan, respawn_ts)
 
             # редактируем сообщение меню, чтобы убрать его
             try:
                 chat_id = data["chat_id"]
                 message_id = data["message_id"]
-                await context.bot.edit_message_text(
-                    chat_id=chat_id,
-                    message_id=message_id,
-                    text=
+                await edit_message_throttled(
+                    context.bot, chat_id, message_id,
                     f"✅ Таймер для {boss_name} установлен на {minutes} минут.")
             except Exception:
+                # ошибка уже записана в traced
                 pass
 
             # удаляем из ожидания
             del awaiting_custom_timer[boss_name]
 
             # отправляем главное меню
-            await update.effective_chat.send_message(
-                "Главное меню:", reply_markup=build_menu_keyboard())
+            await tg_call("send_message", update.effective_chat.send_message(
+                "Главное меню:", reply_markup=build_menu_keyboard()))
             break
 
 
@@ -691,32 +1233,37 @@ async def on_startup(application):
     # пересоздаем все активные таймеры
     await restore_boss_tasks(application)
     # опционально можно расслать меню всем
-    await broadcast_message(application,
-                            "Меню боссов восстановлено после перезапуска")
+    await deliver_event(application, "info",
+                        "Меню боссов восстановлено после перезапуска")
 
 
 async def restore_boss_tasks(application):
-    now_ts = int(datetime.now().timestamp())
+    now_ts = int(CLOCK.now())
     for name, hours, last_killer, respawn_end_ts in get_all_bosses():
         if respawn_end_ts:
             task = asyncio.create_task(
                 boss_respawn_task(application, name, respawn_end_ts)
             )
             boss_tasks[name] = task
-            print(f"[restore] {name}: задача восстановлена (respawn_ts={respawn_end_ts}, now={now_ts})")
+            log_event("timer.restored", boss=name, respawn_ts=respawn_end_ts,
+                      now=now_ts)
 
 async def set_commands(application):
     commands = [
         BotCommand("start", "Регистрация и меню"),
         BotCommand("add_admin", "Добавить админа (только владелец)"),
         BotCommand("help", "Инструкция"),
+        BotCommand("notify", "Личные уведомления вкл/выкл"),
+        BotCommand("bulk_timers", "Массовая установка таймеров (админы)"),
+        BotCommand("export_timers", "Выгрузить таймеры в JSON (админы)"),
+        BotCommand("import_timers", "Загрузить таймеры из JSON (админы)"),
         BotCommand("menu", "Меню боссов")
     ]
-    await application.bot.set_my_commands(commands)
-    await application.bot.set_chat_menu_button(
-        menu_button=MenuButtonCommands())
-    await application.bot.set_chat_menu_button(
-        menu_button=MenuButtonCommands())
+    await tg_call("set_my_commands", application.bot.set_my_commands(commands))
+    await tg_call("set_chat_menu_button", application.bot.set_chat_menu_button(
+        menu_button=MenuButtonCommands()))
+    await tg_call("set_chat_menu_button", application.bot.set_chat_menu_button(
+        menu_button=MenuButtonCommands()))
 
 async def post_init(application):
     # Устанавливаем команды
@@ -724,27 +1271,34 @@ async def post_init(application):
     # Восстанавливаем таймеры боссов после перезапуска
     await restore_boss_tasks(application)
     # Можно расслать уведомление о рестарте
-    await broadcast_message(application, "Меню боссов восстановлено после перезапуска")
+    await deliver_event(application, "info", "Меню боссов восстановлено после перезапуска")
     
 def main():
     if not TOKEN:
-        print("ERROR: TELEGRAM_TOKEN env var not set.")
-        return
+        raise ValueError("Не найден TELEGRAM_TOKEN! Добавь его в Railway → Variables")
+
+    connect_db()
 
     # Создаём приложение один раз и сразу передаём post_init
     app = ApplicationBuilder().token(TOKEN).post_init(post_init).build()
 
     # Регистрируем обработчики
+    app.add_handler(TypeHandler(Update, trace_update_handler), group=-1)
     app.add_handler(CommandHandler("start", start_handler))
     app.add_handler(CommandHandler("menu", menu_handler))
     app.add_handler(CommandHandler("add_admin", add_admin_handler))
     app.add_handler(CommandHandler("help", help_handler))
+    app.add_handler(CommandHandler("notify", notify_handler))
+    app.add_handler(CommandHandler("bulk_timers", bulk_timers_handler))
+    app.add_handler(CommandHandler("export_timers", export_timers_handler))
+    app.add_handler(CommandHandler("import_timers", import_timers_handler))
     app.add_handler(
         MessageHandler(filters.TEXT & ~filters.COMMAND, custom_timer_input_handler)
     )
     app.add_handler(CallbackQueryHandler(callback_query_handler))
+    app.add_error_handler(error_handler)
 
-    print("Bot starting...")
+    log_event("bot.start", delivery_mode=DELIVERY_MODE)
     app.run_polling()  # здесь больше никаких on_startup/post_init не нужно
  
 if __name__ == "__main__":
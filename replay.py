@@ -0,0 +1,342 @@
+"""
+Прогон записанного журнала убийств и таймеров через логику уведомлений
+в симулированном времени.
+
+Журнал — JSONL, по одному событию на строку:
+    {"ts": 1700000000, "event": "kill", "boss": "02.Map ", "clan": "BALDEG"}
+    {"ts": "2024-05-01T12:00:00+03:00", "event": "custom", "boss": "05.Map ", "clan": "AlterEgo", "minutes": 45}
+    {"ts": 1700003600, "event": "other", "boss": "02.Map "}
+
+Использование:
+    python replay.py events.jsonl
+    python replay.py --generate 10000 --seed 1 --users 200 --latency-ms 40
+
+База данных и Telegram не нужны: состояние боссов и пользователи хранятся
+в памяти, а вместо application.bot подставляется бот, который записывает
+каждый send_message/edit_message_text с симулированным временем вызова.
+Таймеры, deliver_event, broadcast_message и send_to_topic — настоящие.
+--latency-ms добавляет задержку каждому вызову API, поэтому опоздание
+показывает, сколько занимает рассылка всем получателям.
+"""
+
+import argparse
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import random
+import sys
+import time
+import contextvars
+from datetime import datetime
+from types import SimpleNamespace
+
+import main as bot
+
+
+class SimulatedClock(bot.Clock):
+    """Виртуальное время: sleep ждёт, пока run_until не продвинет часы."""
+
+    def __init__(self, start: float):
+        self._now = start
+        self._sleepers = []  # heap: (wake_ts, seq, future)
+        self._seq = itertools.count()
+        # реальное время последнего продвижения часов (для оценки накладных)
+        self.advanced_at = time.perf_counter()
+
+    def now(self) -> float:
+        return self._now
+
+    async def sleep(self, seconds: float):
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._sleepers,
+                       (self._now + max(seconds, 0), next(self._seq), fut))
+        await fut
+
+    async def _settle(self):
+        # даём проснувшимся задачам дойти до следующего sleep
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+    async def run_until(self, ts: float):
+        """
+        Пробуждает всех, кто спит до ts включительно, и ставит часы на ts.
+        Таймер, срабатывающий в ту же секунду, что и событие журнала,
+        срабатывает раньше события.
+        """
+        await self._settle()
+        while self._sleepers and self._sleepers[0][0] <= ts:
+            wake_ts, _, fut = heapq.heappop(self._sleepers)
+            if fut.done():
+                # задача отменена
+                continue
+            self._now = max(self._now, wake_ts)
+            self.advanced_at = time.perf_counter()
+            fut.set_result(None)
+            await self._settle()
+        self._now = max(self._now, ts)
+        self.advanced_at = time.perf_counter()
+
+    async def run_all(self):
+        """Прогоняет все оставшиеся таймеры до конца."""
+        await self._settle()
+        while self._sleepers:
+            await self.run_until(max(w for w, _, _ in self._sleepers) + 1)
+
+
+# доставка (kind, boss, плановое время), к которой относится текущий вызов бота
+current_delivery = contextvars.ContextVar("current_delivery", default=None)
+
+
+class ReplayState:
+    """Состояние боссов и пользователей в памяти вместо функций работы с БД."""
+
+    def __init__(self, users: int):
+        self.bosses = {
+            name: {"respawn_hours": hours, "last_killer": None,
+                   "respawn_end_ts": None}
+            for name, hours in bot.BOSSES.items()
+        }
+        self.user_ids = list(range(1, users + 1))
+        # задачи доставки убийств (держим ссылки, пока не завершатся)
+        self.tasks = set()
+
+    def get_boss_info(self, boss_name: str):
+        info = self.bosses.get(boss_name)
+        return dict(info) if info else None
+
+    def set_boss_killer_and_respawn(self, boss_name: str, killer: str,
+                                    respawn_end_ts: int):
+        if boss_name in self.bosses:
+            self.bosses[boss_name]["last_killer"] = killer
+            self.bosses[boss_name]["respawn_end_ts"] = respawn_end_ts
+
+    def get_all_user_ids(self, opted_in_only: bool = False):
+        # в симуляции все пользователи подписаны
+        return list(self.user_ids)
+
+
+class ReplayBot:
+    """Записывает вызовы Telegram API с симулированным временем."""
+
+    def __init__(self, clock: SimulatedClock, latency_s: float):
+        self.clock = clock
+        self.latency_s = latency_s
+        self.deliveries = []
+        self._message_ids = itertools.count(1)
+
+    async def _call(self, method: str, chat_id: int):
+        overhead_ms = (time.perf_counter() - self.clock.advanced_at) * 1000
+        if self.latency_s:
+            await self.clock.sleep(self.latency_s)
+        delivery = current_delivery.get()
+        if delivery is not None:
+            delivery["calls"].append({"method": method,
+                                      "chat_id": chat_id,
+                                      "fired_ts": self.clock.now(),
+                                      "overhead_ms": overhead_ms})
+
+    async def send_message(self, chat_id, text, parse_mode=None,
+                           message_thread_id=None, reply_markup=None):
+        await self._call("send_message", chat_id)
+        return SimpleNamespace(message_id=next(self._message_ids))
+
+    async def edit_message_text(self, chat_id, message_id, text,
+                                parse_mode=None, reply_markup=None):
+        await self._call("edit_message_text", chat_id)
+
+    def track(self, deliver_event):
+        """
+        Оборачивает настоящий deliver_event: он выполняется без изменений,
+        а вызовы бота внутри привязываются к доставке и её плановому времени.
+        """
+        async def tracked(application, kind, text, boss_name=None,
+                          scheduled_ts=None):
+            delivery = {"kind": kind, "boss": boss_name,
+                        "scheduled_ts": scheduled_ts,
+                        "started_ts": self.clock.now(), "calls": []}
+            self.deliveries.append(delivery)
+            token = current_delivery.set(delivery)
+            try:
+                await deliver_event(application, kind, text, boss_name,
+                                    scheduled_ts=scheduled_ts)
+            finally:
+                current_delivery.reset(token)
+        return tracked
+
+
+def parse_ts(value) -> float:
+    if isinstance(value, (int, float)):
+        return float(value)
+    return datetime.fromisoformat(value).timestamp()
+
+
+def load_events(path: str):
+    events = []
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                event = json.loads(line)
+                event["ts"] = parse_ts(event["ts"])
+            except (ValueError, KeyError) as e:
+                raise ValueError(f"{path}:{line_no}: {e}")
+            events.append(event)
+    events.sort(key=lambda e: e["ts"])
+    return events
+
+
+def generate_events(count: int, seed: int, start: float):
+    rng = random.Random(seed)
+    names = list(bot.BOSSES)
+    ts = start
+    events = []
+    for _ in range(count):
+        ts += rng.randint(1, 30 * 60)
+        kind = rng.choice(("kill", "kill", "kill", "custom", "other"))
+        event = {"ts": ts, "event": kind, "boss": rng.choice(names),
+                 "clan": rng.choice(bot.CLANS)}
+        if kind == "custom":
+            event["minutes"] = rng.randint(1, 300)
+        events.append(event)
+    return events
+
+
+def apply_event(application, state: ReplayState, event):
+    """Повторяет то же, что делают обработчики бота для события журнала."""
+    boss_name = event["boss"]
+    hours = bot.BOSSES.get(boss_name)
+    if hours is None:
+        print(f"Пропуск: неизвестный босс {boss_name!r}", file=sys.stderr)
+        return
+    now = bot.CLOCK.now()
+    kind = event["event"]
+    if kind == "kill":
+        respawn_ts = int(now + hours * 3600)
+        bot.schedule_boss(application, boss_name, event["clan"], respawn_ts)
+        # как boss_kill: уведомление об убийстве после установки таймера.
+        # Отдельной задачей — с задержкой API оно ждёт продвижения часов.
+        text = bot.format_kill_text(boss_name, event["clan"], respawn_ts)
+        task = asyncio.create_task(
+            bot.deliver_event(application, "kill", text, boss_name))
+        state.tasks.add(task)
+        task.add_done_callback(state.tasks.discard)
+    elif kind == "custom":
+        bot.schedule_boss(application, boss_name, event["clan"],
+                          int(now + int(event["minutes"]) * 60))
+    elif kind == "other":
+        last_killer = state.bosses[boss_name]["last_killer"]
+        bot.schedule_boss(application, boss_name, last_killer,
+                          int(now + hours * 3600))
+    else:
+        print(f"Пропуск: неизвестное событие {kind!r}", file=sys.stderr)
+
+
+async def replay(events, users: int = 10, latency_ms: float = 0,
+                 mode: str = "warn_topic", edit_in_place: bool = False,
+                 verbose: bool = False):
+    start = events[0]["ts"] if events else time.time()
+    clock = SimulatedClock(start)
+    state = ReplayState(users)
+    replay_bot = ReplayBot(clock, latency_ms / 1000)
+    application = SimpleNamespace(bot=replay_bot)
+
+    bot.CLOCK = clock
+    bot.get_boss_info = state.get_boss_info
+    bot.set_boss_killer_and_respawn = state.set_boss_killer_and_respawn
+    bot.get_all_user_ids = state.get_all_user_ids
+    bot.deliver_event = replay_bot.track(bot.deliver_event)
+    bot.DELIVERY_MODE = mode
+    bot.TOPIC_EDIT_IN_PLACE = edit_in_place
+    if mode in ("warn_topic", "topic", "both"):
+        # вымышленный топик, все вызовы всё равно уходят в ReplayBot
+        bot.GROUP_CHAT_ID, bot.BOSS_TOPIC_ID = -1, 1
+
+    # обычные логи задач бота не нужны в отчёте (ошибки и медленные остаются)
+    if not verbose:
+        bot.logger.setLevel(logging.WARNING)
+    wall_start = time.perf_counter()
+    for event in events:
+        await clock.run_until(event["ts"])
+        apply_event(application, state, event)
+    await clock.run_all()
+    wall_s = time.perf_counter() - wall_start
+    return replay_bot.deliveries, wall_s, clock.now() - start
+
+
+def format_ts(ts) -> str:
+    return bot.format_datetime_ts(int(ts)) if ts is not None else "-"
+
+
+def print_report(deliveries, wall_s: float, simulated_s: float,
+                 events_count: int, show_all: bool):
+    timed = [d for d in deliveries
+             if d["scheduled_ts"] is not None and d["calls"]]
+    if show_all:
+        for d in timed:
+            first = d["calls"][0]["fired_ts"]
+            last = d["calls"][-1]["fired_ts"]
+            print(f"{d['kind']:<8} {d['boss'] or '-':<10} "
+                  f"план {format_ts(d['scheduled_ts'])}  "
+                  f"первый {first - d['scheduled_ts']:+.2f}с  "
+                  f"последний {last - d['scheduled_ts']:+.2f}с  "
+                  f"вызовов {len(d['calls'])}")
+
+    # опоздание — до последнего получателя
+    lateness = [d["calls"][-1]["fired_ts"] - d["scheduled_ts"] for d in timed]
+    calls = [c for d in deliveries for c in d["calls"]]
+    overhead = sorted(c["overhead_ms"] for c in calls)
+    print(f"Событий журнала: {events_count}")
+    print(f"Доставок: {len(deliveries)} "
+          f"(kill={sum(d['kind'] == 'kill' for d in deliveries)}, "
+          f"warn={sum(d['kind'] == 'warn' for d in deliveries)}, "
+          f"respawn={sum(d['kind'] == 'respawn' for d in deliveries)}), "
+          f"вызовов API: {len(calls)}")
+    print(f"Симулировано: {simulated_s / 3600:.1f} ч за {wall_s:.2f} с")
+    if lateness:
+        print(f"Опоздание до последнего получателя: макс {max(lateness):+.2f}с, "
+              f"среднее {sum(lateness) / len(lateness):+.2f}с")
+    if overhead:
+        print(f"Накладные до вызова API: медиана "
+              f"{overhead[len(overhead) // 2]:.3f}мс, макс {overhead[-1]:.3f}мс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("log", nargs="?", help="журнал событий (JSONL)")
+    parser.add_argument("--generate", type=int, metavar="N",
+                        help="вместо журнала сгенерировать N случайных событий")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--users", type=int, default=10,
+                        help="число пользователей для рассылки в личку")
+    parser.add_argument("--latency-ms", type=float, default=0,
+                        help="задержка каждого вызова Telegram API")
+    parser.add_argument("--mode", choices=bot.DELIVERY_MODES, default="warn_topic",
+                        help="DELIVERY_MODE для симуляции")
+    parser.add_argument("--edit-in-place", action="store_true",
+                        help="TOPIC_EDIT_IN_PLACE для симуляции")
+    parser.add_argument("--all", action="store_true",
+                        help="вывести каждое таймерное уведомление")
+    parser.add_argument("--verbose", action="store_true",
+                        help="не скрывать обычные логи бота (JSON в stderr)")
+    args = parser.parse_args()
+
+    if args.generate:
+        events = generate_events(args.generate, args.seed, int(time.time()))
+    elif args.log:
+        events = load_events(args.log)
+    else:
+        parser.error("нужен журнал или --generate N")
+
+    deliveries, wall_s, simulated_s = asyncio.run(
+        replay(events, users=args.users, latency_ms=args.latency_ms,
+               mode=args.mode, edit_in_place=args.edit_in_place,
+               verbose=args.verbose))
+    print_report(deliveries, wall_s, simulated_s, len(events), args.all)
+
+
+if __name__ == "__main__":
+    main()